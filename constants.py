@@ -5,23 +5,29 @@ mpc_lookahead_s = 120
 time_step_s = 1
 
 
-class OvenState(Enum):
-    IDLE = 0
-    HEATING = 1
-    COOLING = 2
-    FAULT = 3
-
+class _FromStringMixin:
     # from string
     @classmethod
     def from_string(cls, s):
-        # case-insensitive string of name
+        # case-insensitive string of name, looked up in a lowercase name cache built on first use
+        cache = cls.__dict__.get('_name_cache')
+        if cache is None:
+            cache = {member.name.lower(): member for member in cls}
+            setattr(cls, '_name_cache', cache)
         try:
-            return cls[s.upper()]
+            return cache[s.lower()]
         except KeyError:
-            raise ValueError()
+            raise ValueError(s)
+
+
+class OvenState(_FromStringMixin, Enum):
+    IDLE = 0
+    HEATING = 1
+    COOLING = 2
+    FAULT = 3
 
 
-class ControlState(Enum):
+class ControlState(_FromStringMixin, Enum):
     IDLE = 0
     PREPARING = 1
     RUNNING = 2
@@ -29,27 +35,9 @@ class ControlState(Enum):
     CANCELLED = 4
     FAULT = 5
 
-    # from string
-    @classmethod
-    def from_string(cls, s):
-        # case-insensitive string of name
-        try:
-            return cls[s.upper()]
-        except KeyError:
-            raise ValueError()
-
 
-class LogSeverity(Enum):
+class LogSeverity(_FromStringMixin, Enum):
     DEBUG = 0
     INFO = 1
     WARN = 2
     CRITICAL = 3
-
-    # from string
-    @classmethod
-    def from_string(cls, s):
-        # case-insensitive string of name
-        try:
-            return cls[s.upper()]
-        except KeyError:
-            raise ValueError()
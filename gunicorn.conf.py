@@ -0,0 +1,15 @@
+import sys
+
+# the server owns the serial port, the reset GPIO and the control process, and Socket.IO clients need to stay on the
+# same process, so it must run as a single worker. Requests are handled concurrently by the worker's threads.
+workers = 1
+threads = 100
+bind = '0.0.0.0:5000'
+
+
+def worker_exit(server, worker):
+    # runs in the worker before it exits. The TMS and MPC threads are not daemons, so without stopping them the worker
+    # would hang until it is killed
+    mpc_server = sys.modules.get('mpc_server')
+    if mpc_server is not None:
+        mpc_server.shutdown()
@@ -1,16 +1,16 @@
+import logging
 import threading
 import time
-from schemas import OvenStatusSchema, LogMessageSchema
+from schemas import OvenStatus, LogMessage
 from constants import OvenState, LogSeverity
-from typing import Callable, List
+from typing import Callable, List, Tuple
 
-# Simulation code adapted from standalone_test/mpc_sim.py
-from casadi import SX, DM, vertcat
-import numpy as np
+logger = logging.getLogger(__name__)
 
-from pprint import pprint
+# Simulation code adapted from standalone_test/mpc_sim.py
 
 set_error_after_s = 45  # Simulate an error after this many seconds
+simulation_interval_s = 1.0  # Simulate every second
 
 # Parameters for the 2nd order transfer function
 k = 4.7875771211019
@@ -18,35 +18,36 @@ omega = 0.005328475532226316
 xi = 1.54264888649055
 
 # Define the states (temperature and its derivative)
-T = DM(25)  # Initial temperature
-dT = DM(0)  # Initial temperature derivative
+T = 25.0  # Initial temperature
+dT = 0.0  # Initial temperature derivative
 
 # Define the input (heater PWM value)
-u = DM(0)  # Initial duty cycle
+u = 0  # Initial duty cycle
 
-# Differential equations
-a1 = SX(k * omega ** 2)
-a2 = SX(2 * xi * omega)
-a3 = SX(omega ** 2)
+# Differential equations, plain floats since this is evaluated numerically once per tick
+a1 = k * omega ** 2
+a2 = 2 * xi * omega
+a3 = omega ** 2
 
 
-def system_dynamics(T, dT, u, time_step=1.0):
+def system_dynamics(T: float, dT: float, u: float, time_step: float = 1.0) -> Tuple[float, float]:
     dT_next = a1 * u - a2 * dT - a3 * T
     T_next = T + dT * time_step  # Integrate temperature over time step using the previous derivative
     return T_next, dT_next
 
 
 class MockThermalManagementSystem:
-    __log_messages: List[LogMessageSchema] = []
-    __oven_status: OvenStatusSchema = None
+    __log_messages: List[LogMessage] = []
+    __log_version = 0
+    __oven_status: OvenStatus = None
     __oven_state = OvenState.IDLE
 
-    on_log_message: Callable[[LogMessageSchema], None] = None
-    on_oven_status: Callable[[OvenStatusSchema], None] = None
+    on_log_message: Callable[[LogMessage], None] = None
+    on_oven_status: Callable[[OvenStatus], None] = None
     on_reset: Callable[[], None] = None
 
-    def __init__(self, on_log_message: Callable[[LogMessageSchema], None] = None,
-                 on_oven_status: Callable[[OvenStatusSchema], None] = None,
+    def __init__(self, on_log_message: Callable[[LogMessage], None] = None,
+                 on_oven_status: Callable[[OvenStatus], None] = None,
                  on_reset: Callable[[], None] = None):
         self.on_log_message = on_log_message
         self.on_oven_status = on_oven_status
@@ -56,45 +57,56 @@ class MockThermalManagementSystem:
         self.__T = T
         self.__dT = dT
         self.__u = u
+        self.__should_exit = threading.Event()
         self.__simulation_thread = threading.Thread(target=self.__simulate_periodically)
         self.__simulation_thread.daemon = True
         self.__simulation_thread.start()
 
     def __simulate_periodically(self):
         error_time = time.time() + set_error_after_s
-        while True:
+        # schedule ticks from a fixed start so the simulation time doesn't drift by the cost of each tick
+        next_tick = time.monotonic()
+        while not self.__should_exit.is_set():
 
             # if time.time() > error_time:
             #     self.__oven_state = OvenState.FAULT
 
             self.__duty_cycle = 0
             self.__simulate()
-            time.sleep(1)  # Simulate every second
+            next_tick += simulation_interval_s
+            self.__should_exit.wait(max(0.0, next_tick - time.monotonic()))
 
     def __simulate(self):
         # Update the system dynamics based on the current duty cycle
         self.__T, self.__dT = system_dynamics(self.__T, self.__dT, self.__u, time_step=1.0)
         # Update the oven status with the new temperature and other required fields
-        self.__oven_status = OvenStatusSchema().load({
-            "time": int(time.time() * 1000),
-            "temperature": float(self.__T),
-            "state": self.__oven_state.value,
-            "duty_cycle": self.duty_cycle,
-            "door_open": False,  # Assuming door is closed for simulation; update if door status is available
-            "errors": []  # Assuming no errors for simulation; update if error information is available
-        })
+        self.__oven_status = OvenStatus(
+            time=time.time_ns() // 1_000_000,
+            temperature=self.__T,
+            state=self.__oven_state,
+            duty_cycle=self.duty_cycle,
+            door_open=False,  # Assuming door is closed for simulation; update if door status is available
+            errors=[]  # Assuming no errors for simulation; update if error information is available
+        )
         # If there are any registered callbacks, call them with the new oven status
         if self.on_oven_status:
             self.on_oven_status(self.__oven_status)
 
-        pprint(self.__oven_status)
+        logger.debug("oven=%r", self.__oven_status)
 
     @property
     def log_messages(self):
         return self.__log_messages
 
     @property
-    def oven_status(self) -> OvenStatusSchema:
+    def log_version(self) -> int:
+        """
+        Incremented for every new log message, the simulation doesn't produce any so it stays 0
+        """
+        return self.__log_version
+
+    @property
+    def oven_status(self) -> OvenStatus:
         return self.__oven_status
 
     @property
@@ -106,16 +118,20 @@ class MockThermalManagementSystem:
 
     @property
     def duty_cycle(self) -> int:
-        return int(self.__u)
+        return self.__u
 
     def set_duty_cycle(self, value: int):
-        self.__u = DM(value)  # Update the duty cycle in the simulation model
+        self.__u = value  # Update the duty cycle in the simulation model
+
+    def close(self):
+        self.__should_exit.set()
+        self.__simulation_thread.join()
 
     def reset(self):
         # Reset the simulation environment here
-        self.__T = DM(25)  # Reset temperature to initial value
-        self.__dT = DM(0)  # Reset temperature derivative to initial value
-        self.__u = DM(0)  # Reset duty cycle to initial value
+        self.__T = T  # Reset temperature to initial value
+        self.__dT = dT  # Reset temperature derivative to initial value
+        self.__u = u  # Reset duty cycle to initial value
         # Call the simulation to update the oven status
         self.__simulate()
 
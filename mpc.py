@@ -1,19 +1,32 @@
+import collections
 import datetime
+import functools
+import hashlib
+import logging
 import multiprocessing
+import os
+import shlex
+import shutil
+import subprocess
 import threading
+import weakref
 
 from ctypes import Structure, c_double, c_int, c_bool
-from typing import Callable, List, Tuple
+from multiprocessing.connection import Connection
+from typing import Callable, Deque, List, Tuple
 import time
 
-from pprint import pprint
 
 import do_mpc
+import numpy as np
 from casadi import *
 from scipy.interpolate import interp1d
+from scipy.signal import cont2discrete
 
+from constants import ControlState, OvenState, mpc_lookahead_s, pre_curve_time_s, time_step_s
 from schemas import *
-from utils import calculate_derivative
+
+logger = logging.getLogger(__name__)
 
 new_run_threshold_temperature = 45  # need to be below this temperature to start a new run
 settle_time = datetime.timedelta(seconds=10)
@@ -21,24 +34,147 @@ preheat_time = datetime.timedelta(seconds=30)
 temperature_derivation_timescale = datetime.timedelta(seconds=2)
 preheat_max_temperature = 50
 
-pre_curve_time_s = 15
-mpc_lookahead_s = 120
-time_step_s = 1
 mpc_horizon = int(mpc_lookahead_s / time_step_s)
 
+# control state values checked by the monitor on every tick
+_inactive_control_states = frozenset({ControlState.IDLE.value, ControlState.CANCELLED.value, ControlState.FAULT.value,
+                                      ControlState.COMPLETE.value})
+_reporting_control_states = frozenset({ControlState.RUNNING.value, ControlState.COMPLETE.value})
+
+# initial number of samples the actual curve history has room for, it grows as needed
+history_initial_size = 4096
+
+# the NLP is compiled to native code in the background and the library is reused whenever the same curve runs again
+jit_enabled = True
+jit_compiler_flags = ['-O3', '-march=native']
+jit_cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.casadi_jit')
+jit_cache_size = 16  # number of compiled solvers kept on disk
+
+
+def _jit_name(curve: ReflowCurveSchema) -> str:
+    """
+    Name the compiled solver after a fingerprint of everything that goes into the NLP
+
+    :param curve: The curve the MPC is set up for
+    :return: The name of the compiled solver, a valid C identifier
+    """
+    with open(__file__, 'rb') as f:
+        source = f.read()
+    fingerprint = hashlib.sha1(repr((curve['times'], curve['temperatures'], mpc_horizon, time_step_s,
+                                     CasadiMeta.version(), do_mpc.__version__)).encode() + source).hexdigest()
+    return f'mpc_{fingerprint}'
+
+
+def _prune_jit_cache():
+    """
+    Remove the least recently used compiled solvers beyond jit_cache_size
+    """
+    libraries = sorted((entry for entry in os.scandir(jit_cache_dir) if entry.name.endswith('.so')),
+                       key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in libraries[jit_cache_size:]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+# MPCs in the worker's setup cache that already run on a compiled solver
+_compiled_mpcs = weakref.WeakSet()
+
+
+def _use_compiled_solver(mpc: do_mpc.controller.MPC, curve: ReflowCurveSchema):
+    """
+    Swap the interpreted IPOPT solver of the MPC for a compiled one
+
+    If the curve has been compiled before, the library is loaded from the cache. Otherwise the C code is generated and
+    compiled by a detached, low priority process, so the current run keeps the interpreted solver instead of waiting
+    for the compiler, and the next run of the same curve picks up the library.
+
+    :param mpc: The MPC, after setup
+    :param curve: The curve the MPC is set up for
+    """
+    compiler = shutil.which('gcc')
+    if not jit_enabled or compiler is None:
+        return
+
+    name = _jit_name(curve)
+    library = os.path.join(jit_cache_dir, f'{name}.so')
+    source = os.path.join(jit_cache_dir, f'{name}.c')
+
+    if os.path.exists(library):
+        try:
+            mpc.S = nlpsol('S', 'ipopt', library, mpc.settings.nlpsol_opts)
+        except RuntimeError as e:
+            logger.warning("Failed to load compiled solver %s, using the interpreted one: %s", library, e)
+            return
+        os.utime(library)  # mark as recently used
+        _compiled_mpcs.add(mpc)
+        return
+
+    if os.path.exists(source):
+        return  # already being compiled
+
+    try:
+        os.makedirs(jit_cache_dir, exist_ok=True)
+        # CasADi only generates code into the working directory
+        mpc.S.generate_dependencies(f'{name}.c')
+        os.replace(f'{name}.c', source)
+
+        partial_library = f'{library}.tmp'
+        compile_command = ' '.join(shlex.quote(arg) for arg in
+                                   [compiler, *jit_compiler_flags, '-fPIC', '-shared', source, '-o', partial_library])
+        subprocess.Popen(['nice', '-n', '19', 'sh', '-c',
+                          f'{compile_command} && mv -f {shlex.quote(partial_library)} {shlex.quote(library)}; '
+                          f'rm -f {shlex.quote(source)} {shlex.quote(partial_library)}'],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        _prune_jit_cache()
+    except (RuntimeError, OSError) as e:
+        logger.warning("Failed to start compiling the solver: %s", e)
+
+
+def _prepare_curve(curve: ReflowCurveSchema) -> Tuple[Tuple[float, ...], Tuple[float, ...]]:
+    """
+    Get the part of a curve that is followed by the MPC
+
+    :param curve: The requested curve
+    :return: The times and temperatures shifted by the pre-curve time, up to and including the peak temperature
+    """
+    # no copy when start() already converted the curve, so the shift must not be done in place
+    times = np.asarray(curve['times'], dtype=np.float64) + pre_curve_time_s
+    temperatures = np.asarray(curve['temperatures'], dtype=np.float64)
+
+    # get index of peak temperature
+    peak_temperature_index = int(np.argmax(temperatures))
+
+    # anything after peak temperature is removed. Tuples, since they are used as the MPC setup cache key
+    return (tuple(times[:peak_temperature_index + 1].tolist()),
+            tuple(temperatures[:peak_temperature_index + 1].tolist()))
+
 
-def _setup_model_and_mpc(curve: ReflowCurveSchema):
-    reflow_curve_function = interp1d(curve['times'], curve['temperatures'], kind='linear', bounds_error=False,
-                                     fill_value='extrapolate')
+# setting up the MPC traces the symbolic problem and initializes the solver, which takes a while. The control worker
+# lives across runs, so keep the results for recent curves in it
+@functools.lru_cache(maxsize=8)
+def _setup_model_and_mpc(times: Tuple[float, ...], temperatures: Tuple[float, ...]):
+    # times are validated to be ascending, so interp1d doesn't need to sort them
+    reflow_curve_function = interp1d(times, temperatures, kind='linear', bounds_error=False,
+                                     fill_value='extrapolate', assume_sorted=True)
 
-    peak_temperature = max(curve['temperatures'])
+    peak_temperature = max(temperatures)
 
     # Parameters for the 2nd order transfer function
     k = 4.7875771211019
     omega = 0.005328475532226316
     xi = 1.54264888649055
 
-    model = do_mpc.model.Model('continuous')
+    # Continuous state space form x' = A x + B u of the transfer function, with x = [T, dT]
+    A = np.array([[0, 1], [-omega ** 2, -2 * xi * omega]])
+    B = np.array([[0], [k * omega ** 2]])
+
+    # The dynamics are linear, so discretize them exactly (zero-order hold on u) instead of letting do-mpc
+    # add collocation points. This leaves only the states and inputs of each step as optimization variables.
+    Ad, Bd, _, _, _ = cont2discrete((A, B, np.eye(2), np.zeros((2, 1))), time_step_s, method='zoh')
+
+    model = do_mpc.model.Model('discrete')
 
     # Define the states (temperature and its derivative)
     T = model.set_variable(var_type='_x', var_name='T')
@@ -50,15 +186,11 @@ def _setup_model_and_mpc(curve: ReflowCurveSchema):
     # Target temperature as time-varying parameter
     T_ref = model.set_variable('_tvp', 'T_ref')
 
-    # Differential equations
-    a1 = SX(k * omega ** 2)
-    a2 = SX(2 * xi * omega)
-    a3 = SX(omega ** 2)
-
-    dT_next = a1 * u - a2 * dT - a3 * T
-    T_next = dT
+    # Difference equations
+    T_next = Ad[0, 0] * T + Ad[0, 1] * dT + Bd[0, 0] * u
+    dT_next = Ad[1, 0] * T + Ad[1, 1] * dT + Bd[1, 0] * u
 
-    # Set the differential equations
+    # Set the difference equations
     model.set_rhs('T', T_next)
     model.set_rhs('dT', dT_next)
 
@@ -66,6 +198,19 @@ def _setup_model_and_mpc(curve: ReflowCurveSchema):
 
     mpc = do_mpc.controller.MPC(model)
     mpc.settings.supress_ipopt_output()
+    # linear dynamics and a quadratic cost make this a QP, so IPOPT only needs to evaluate the derivatives once
+    mpc.settings.nlpsol_opts.update({
+        'ipopt.hessian_constant': 'yes',
+        'ipopt.jac_c_constant': 'yes',
+        'ipopt.jac_d_constant': 'yes',
+    })
+    # do-mpc passes the previous solution and multipliers as the initial guess, let IPOPT start from them as is
+    mpc.settings.nlpsol_opts.update({
+        'ipopt.warm_start_init_point': 'yes',
+        'ipopt.warm_start_bound_push': 1e-8,
+        'ipopt.warm_start_mult_bound_push': 1e-8,
+        'ipopt.mu_init': 1e-6,
+    })
 
     setup_mpc = {
         'n_horizon': mpc_horizon,
@@ -77,10 +222,22 @@ def _setup_model_and_mpc(curve: ReflowCurveSchema):
 
     tvp_template = mpc.get_tvp_template()
 
+    # sample the reference once on a time step grid covering the whole curve plus one horizon, so each step only needs
+    # a single vectorized interpolation instead of calling interp1d for every point of the horizon
+    reference_times = np.arange(0, times[-1] + mpc_lookahead_s + 1, time_step_s, dtype=np.float64)
+    reference_temperatures = reflow_curve_function(reference_times).astype(np.float64)
+    # the tvp structure has one entry per horizon step plus the terminal one
+    horizon_offsets = np.arange(mpc_horizon + 1) * setup_mpc['t_step']
+    # past the grid, extrapolate along the last segment like interp1d does
+    end_slope = (reference_temperatures[-1] - reference_temperatures[-2]) / (reference_times[-1] - reference_times[-2])
+
     def tvp_fun(t_now):
-        for k in range(mpc_horizon):
-            t = t_now + k * setup_mpc['t_step']
-            tvp_template['_tvp', k, 'T_ref'] = reflow_curve_function(t)
+        horizon_times = t_now + horizon_offsets
+        references = np.interp(horizon_times, reference_times, reference_temperatures)
+        past_grid = horizon_times > reference_times[-1]
+        references[past_grid] = reference_temperatures[-1] + (horizon_times[past_grid] - reference_times[-1]) * end_slope
+        # assign the whole horizon through a single structure slice instead of one entry at a time
+        tvp_template['_tvp', :, 'T_ref'] = references.tolist()
         return tvp_template
 
     mpc.set_tvp_fun(tvp_fun)
@@ -112,88 +269,91 @@ def _setup_model_and_mpc(curve: ReflowCurveSchema):
     return model, mpc
 
 
-def _run_curve(curve: ReflowCurveSchema, control_state: multiprocessing.Value,
-               current_temperature: multiprocessing.Value, current_temperature_derivative: multiprocessing.Value,
-               current_door_open: multiprocessing.Value, desired_oven_state: multiprocessing.Value,
-               desired_duty_cycle: multiprocessing.Value, curve_duration: multiprocessing.Value,
-               should_exit: multiprocessing.Event):
-    curve_duration.value = 0
-    desired_duty_cycle.value = 0
-    desired_oven_state.value = OvenState.IDLE.value
-    control_state.value = ControlState.PREPARING.value
+class SharedState(Structure):
+    """
+    State shared between the monitor and the control process, kept in a single shared memory block
+    """
+    _fields_ = [
+        ('control_state', c_int),
+        ('temperature', c_double),
+        ('temperature_derivative', c_double),
+        ('door_open', c_bool),
+        ('desired_oven_state', c_int),
+        ('desired_duty_cycle', c_int),
+        ('curve_duration', c_int),
+        ('running', c_bool),
+    ]
+
+
+def _run_curve(curve: ReflowCurveSchema, state: SharedState, should_exit: multiprocessing.Event):
+    state.curve_duration = 0
+    state.desired_duty_cycle = 0
+    state.desired_oven_state = OvenState.IDLE.value
+    state.control_state = ControlState.PREPARING.value
 
-    # add pre-curve time
-    curve['times'] = [t + pre_curve_time_s for t in curve['times']]
-
-    # get index of peak temperature
-    peak_temperature = max(curve['temperatures'])
-    peak_temperature_index = curve['temperatures'].index(peak_temperature)
     end_temperature = curve['temperatures'][-1]
+    curve['times'], curve['temperatures'] = _prepare_curve(curve)
+    peak_temperature = curve['temperatures'][-1]
 
-    # anything after peak temperature is removed.
-    curve['times'] = curve['times'][:peak_temperature_index + 1]
-    curve['temperatures'] = curve['temperatures'][:peak_temperature_index + 1]
-
-    model, mpc = _setup_model_and_mpc(curve)
+    model, mpc = _setup_model_and_mpc(curve['times'], curve['temperatures'])
+    mpc.reset_history()
+    if mpc not in _compiled_mpcs:
+        _use_compiled_solver(mpc, curve)
 
     # TODO would be cool to do dynamic preheat. I.e. we can start a curve if we're at 90°C,
     #  target preheat to the relevant part of the provided curve, cutting off the lower parts, once we have momentum
     #  from the preheat engage MPC control
 
-    if current_temperature.value > new_run_threshold_temperature:
+    if state.temperature > new_run_threshold_temperature:
         # log "waiting for cooldown"
-        print(f"Waiting for cooldown, current temperature is {current_temperature.value}°C")
-        desired_oven_state.value = OvenState.COOLING.value
-        desired_duty_cycle.value = 0
-        while current_temperature.value > new_run_threshold_temperature:
-            if should_exit.is_set():
+        logger.info("Waiting for cooldown, current temperature is %s°C", state.temperature)
+        state.desired_oven_state = OvenState.COOLING.value
+        state.desired_duty_cycle = 0
+        while state.temperature > new_run_threshold_temperature:
+            if should_exit.wait(0.5):
                 return
-            time.sleep(0.1)
 
     # need to remove all temperatures from the curve that are less than the current temperature, also need to remove times
     for i, t in enumerate(curve['times']):
-        if t < curve_duration.value:
+        if t < state.curve_duration:
             curve['times'] = curve['times'][i:]
             curve['temperatures'] = curve['temperatures'][i:]
             break
 
     # log "waiting for door to be closed"
-    print("Waiting for door to be closed")
-    while current_door_open.value:
-        if should_exit.is_set():
+    logger.info("Waiting for door to be closed")
+    while state.door_open:
+        if should_exit.wait(0.1):
             return
-        time.sleep(0.1)
 
     # settling time, door closed
     # log "settling..."
-    print("Settling...")
-    desired_oven_state.value = OvenState.IDLE.value
+    logger.info("Settling...")
+    state.desired_oven_state = OvenState.IDLE.value
     settle_start_time = time.monotonic()
     while time.monotonic() - settle_start_time < settle_time.total_seconds():
-        if should_exit.is_set():
-            return
-        if current_door_open.value:
+        if state.door_open:
             # log "door opened during settling"
             settle_start_time = time.monotonic()
-        time.sleep(0.1)
+        if should_exit.wait(0.1):
+            return
 
     # log "preheating"
-    print("Preheating...")
-    desired_oven_state.value = OvenState.HEATING.value
-    desired_duty_cycle.value = 100
+    logger.info("Preheating...")
+    state.desired_oven_state = OvenState.HEATING.value
+    state.desired_duty_cycle = 100
     preheat_start_time = time.monotonic()
-    while time.monotonic() - preheat_start_time < preheat_time.total_seconds() and current_temperature.value < preheat_max_temperature:
-        if should_exit.is_set():
+    while time.monotonic() - preheat_start_time < preheat_time.total_seconds() and state.temperature < preheat_max_temperature:
+        if should_exit.wait(0.5):
             return
-        time.sleep(0.1)
 
     # log "beginning reflow"
-    print("Beginning reflow...")
-    control_state.value = ControlState.RUNNING.value
+    logger.info("Beginning reflow...")
+    state.control_state = ControlState.RUNNING.value
 
     peak_hit = False
-    mpc.x0['T'] = current_temperature.value
-    mpc.x0['dT'] = current_temperature_derivative.value
+    mpc.x0['T'] = state.temperature
+    mpc.x0['dT'] = state.temperature_derivative
     mpc.set_initial_guess()
     curve_start_time = time.monotonic()
 
@@ -205,61 +365,87 @@ def _run_curve(curve: ReflowCurveSchema, control_state: multiprocessing.Value,
 
             duration = datetime.timedelta(seconds=time.monotonic() - curve_start_time)
 
-            if current_temperature.value >= peak_temperature and not peak_hit:
+            if state.temperature >= peak_temperature and not peak_hit:
                 peak_hit = True
-                desired_oven_state.value = OvenState.COOLING.value
-                print(f"Peak temperature of {peak_temperature}°C reached at t={duration.seconds}s")
-                print(f'Starting cooldown')
-
-            if current_temperature.value <= end_temperature and duration.seconds >= curve['times'][-1]:
-                print(f"End temperature of {end_temperature}°C reached at t={duration.seconds}s")
-                print(f'Ending reflow curve')
-                desired_oven_state.value = OvenState.IDLE.value
-                control_state.value = ControlState.COMPLETE.value
+                state.desired_oven_state = OvenState.COOLING.value
+                logger.info("Peak temperature of %s°C reached at t=%ss", peak_temperature, duration.seconds)
+                logger.info("Starting cooldown")
+
+            if state.temperature <= end_temperature and duration.seconds >= curve['times'][-1]:
+                logger.info("End temperature of %s°C reached at t=%ss", end_temperature, duration.seconds)
+                logger.info("Ending reflow curve")
+                state.desired_oven_state = OvenState.IDLE.value
+                state.control_state = ControlState.COMPLETE.value
                 break
 
-            x0 = np.array([[current_temperature.value], [current_temperature_derivative.value]])
+            x0 = np.array([[state.temperature], [state.temperature_derivative]])
 
             u0 = mpc.make_step(x0)
+            if not mpc.solver_stats['success']:
+                logger.warning("MPC solver did not converge at t=%ss: %s", duration.seconds,
+                               mpc.solver_stats['return_status'])
             if duration.seconds > curve['times'][-1] and peak_hit:
                 u0 = np.array([[0]])
             # clamp to 0-100 integer
-            desired_duty_cycle.value = int(np.clip(u0[0, 0], 0, 100))
-            print(f'At t={duration.seconds}s, T={x0[0, 0]}, dT={x0[1, 0]}, pwm={desired_duty_cycle.value}')
-            curve_duration.value = duration.seconds
+            state.desired_duty_cycle = int(np.clip(u0[0, 0], 0, 100))
+            logger.debug("At t=%ss, T=%s, dT=%s, pwm=%s", duration.seconds, x0[0, 0], x0[1, 0],
+                         state.desired_duty_cycle)
+            state.curve_duration = duration.seconds
 
             loop_time = time.monotonic() - loop_start_time
             if loop_time > time_step_s:
-                print(f"Loop time of {loop_time}s is greater than time step of {time_step_s}s")
-            else:
-                time.sleep(time_step_s - loop_time)
+                logger.warning("Loop time of %ss is greater than time step of %ss", loop_time, time_step_s)
+            elif should_exit.wait(time_step_s - loop_time):
+                return
         except KeyboardInterrupt:
-            print("mpc keyboardinterrupt")
+            logger.info("mpc keyboardinterrupt")
             break
 
 
+def _control_worker(curves: Connection, state: SharedState, should_exit_mpc: multiprocessing.Event,
+                    should_exit: multiprocessing.Event):
+    """
+    Run the curves sent by the parent one after another
+
+    The worker is kept alive between runs, so the MPC setups cached in it are reused when a curve is run again.
+
+    :param curves: The pipe the curves to run are received from
+    :param state: The shared state, running is set by the parent when it sends a curve and cleared once the run ended
+    :param should_exit_mpc: Set to stop the current run
+    :param should_exit: Set to stop the worker
+    """
+    while not should_exit.is_set():
+        if not curves.poll(0.1):
+            continue
+        curve = curves.recv()
+        try:
+            _run_curve(curve, state, should_exit_mpc)
+        except Exception:
+            logger.exception("Control run failed")
+        finally:
+            state.running = False
+
+
 class ModelPredictiveControl:
     __curve: ReflowCurveSchema
 
     __control_process: multiprocessing.Process = None
+    __curve_reader, __curve_writer = multiprocessing.Pipe(duplex=False)
     __monitor_thread: threading.Thread
 
-    __current_temperature = multiprocessing.Value(c_double)
-    __current_temperature_derivative = multiprocessing.Value(c_double)
-    __current_door_open = multiprocessing.Value(c_bool)
-    __control_state = multiprocessing.Value(c_int)
-
-    __desired_oven_state = multiprocessing.Value(c_int)
-    __desired_duty_cycle = multiprocessing.Value(c_int)
+    __state = multiprocessing.RawValue(SharedState)
 
-    __curve_duration = multiprocessing.Value(c_int)
-    __curve_duration_history: List[float] = []
-    __curve_temperature_history: List[float] = []
+    # actual curve history, only the first __history_length samples are valid
+    __curve_duration_history = np.empty(history_initial_size, dtype=np.float64)
+    __curve_temperature_history = np.empty(history_initial_size, dtype=np.float64)
+    __history_length = 0
 
     __should_exit_mpc = multiprocessing.Event()
     __should_exit = multiprocessing.Event()
 
-    __temperatures: List[Tuple[float, float]] = []
+    # recent temperature samples and their times, kept as two parallel deques
+    __temperature_times: Deque[float] = collections.deque()
+    __temperature_values: Deque[float] = collections.deque()
 
     __error_msg = ""
 
@@ -269,71 +455,77 @@ class ModelPredictiveControl:
 
     def __init__(self, on_reflow_status: Callable[[ReflowStatusSchema], None] = None):
         self.on_reflow_status = on_reflow_status
-        self.__control_state.value = ControlState.IDLE.value
-        self.__desired_oven_state.value = OvenState.IDLE.value
-        self.__desired_duty_cycle.value = 0
+        self.__state.control_state = ControlState.IDLE.value
+        self.__state.desired_oven_state = OvenState.IDLE.value
+        self.__state.desired_duty_cycle = 0
 
-        self.__curve = ReflowCurveSchema().load({
+        # the default curve is known to be valid, so it's written in its loaded form instead of going through the schema
+        self.__curve = {
             "name": "Unleaded",
             "description": "Default unleaded curve",
             "times": [90, 180, 210, 240, 270],
-            "temperatures": [90, 130, 138, 165, 138]
-        })
+            "temperatures": [90.0, 130.0, 138.0, 165.0, 138.0]
+        }
         self.__monitor_thread = threading.Thread(target=self.__monitor)
         self.__monitor_thread.start()
 
     def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Stop the control worker and the monitor thread
+        """
         self.__should_exit_mpc.set()
+        self.__should_exit.set()
         if self.__control_process and self.__control_process.is_alive():
             self.__control_process.join()
-        self.__should_exit.set()
         self.__monitor_thread.join()
 
     def __monitor(self):
         """
         Monitor the control process and update appropriate things
         """
-        last_oven_state = self.__desired_oven_state.value
-        last_duty_cycle = self.__desired_duty_cycle.value
+        last_oven_state = self.__state.desired_oven_state
+        last_duty_cycle = self.__state.desired_duty_cycle
         last_reflow_status = {}
 
         while not self.__should_exit.is_set():
-            control_state = self.__control_state.value
-            desired_oven_state = self.__desired_oven_state.value
-            desired_duty_cycle = self.__desired_duty_cycle.value
-            curve_duration = self.__curve_duration.value
+            control_state = self.__state.control_state
+            desired_oven_state = self.__state.desired_oven_state
+            desired_duty_cycle = self.__state.desired_duty_cycle
+            curve_duration = self.__state.curve_duration
 
+            # built in its loaded form directly, it's only serialized once when it's emitted
             reflow_status = {
-                'state': self.__control_state.value,
+                'state': ControlState(control_state),
             }
 
             # if mpc should be in a "running" state
-            if control_state not in [ControlState.IDLE.value, ControlState.CANCELLED.value,
-                                     ControlState.FAULT.value, ControlState.COMPLETE.value]:
+            if control_state not in _inactive_control_states:
                 if not self.busy:
                     # log "control process died"
-                    self.__control_state.value = ControlState.FAULT.value
-                    self.__desired_oven_state.value = OvenState.IDLE.value
-                    self.__desired_duty_cycle.value = 0
+                    self.__state.control_state = ControlState.FAULT.value
+                    self.__state.desired_oven_state = OvenState.IDLE.value
+                    self.__state.desired_duty_cycle = 0
                     self.__error_msg = "Control process died"
 
                 else:
                     # update curve history, but only if the duration has changed. Need to handle first duration too
                     if control_state == ControlState.RUNNING.value:
-                        if not self.__curve_duration_history or self.__curve_duration_history[
-                            -1] != curve_duration:
-                            self.__curve_duration_history.append(curve_duration)
-                            self.__curve_temperature_history.append(self.temperature)
-
-                    if control_state in [ControlState.RUNNING.value, ControlState.COMPLETE.value]:
-                        reflow_status['actual_temperatures'] = ReflowCurveSchema().dump({
-                            'times': self.__curve_duration_history,
-                            'temperatures': self.__curve_temperature_history
-                        })
+                        if not self.__history_length or self.__curve_duration_history[
+                            self.__history_length - 1] != curve_duration:
+                            self.__append_history(curve_duration, self.temperature)
+
+                    if control_state in _reporting_control_states:
+                        reflow_status['actual_temperatures'] = {
+                            'times': self.__curve_duration_history[:self.__history_length].tolist(),
+                            'temperatures': self.__curve_temperature_history[:self.__history_length].tolist()
+                        }
             else:
                 # make sure desired oven state is idle and duty cycle is 0
-                self.__desired_oven_state.value = OvenState.IDLE.value
-                self.__desired_duty_cycle.value = 0
+                self.__state.desired_oven_state = OvenState.IDLE.value
+                self.__state.desired_duty_cycle = 0
 
             if control_state == ControlState.FAULT.value:
                 reflow_status['error'] = self.__error_msg
@@ -341,7 +533,7 @@ class ModelPredictiveControl:
             # compare reflow_status to last_reflow_status
             if reflow_status != last_reflow_status:
                 if self.on_reflow_status:
-                    self.on_reflow_status(ReflowStatusSchema().load(reflow_status))
+                    self.on_reflow_status(reflow_status)
 
             if desired_oven_state != last_oven_state:
                 if self.on_desired_oven_state:
@@ -357,9 +549,18 @@ class ModelPredictiveControl:
 
             time.sleep(0.1)
 
+    def __append_history(self, duration: float, temperature: float):
+        if self.__history_length == self.__curve_duration_history.size:
+            # out of room, double the buffers
+            self.__curve_duration_history = np.resize(self.__curve_duration_history, 2 * self.__history_length)
+            self.__curve_temperature_history = np.resize(self.__curve_temperature_history, 2 * self.__history_length)
+        self.__curve_duration_history[self.__history_length] = duration
+        self.__curve_temperature_history[self.__history_length] = temperature
+        self.__history_length += 1
+
     @property
     def busy(self) -> bool:
-        return self.__control_process and self.__control_process.is_alive()
+        return self.__control_process and self.__control_process.is_alive() and self.__state.running
 
     @property
     def curve(self) -> ReflowCurveSchema:
@@ -373,64 +574,77 @@ class ModelPredictiveControl:
 
     @property
     def status(self) -> ControlStatusSchema:
-        return ControlStatusSchema().load({
+        # built from internal state that is already valid, so it's constructed in its loaded form directly instead of
+        # being validated by the schema on every status request
+        return {
             'curve': self.__curve,
             'reflow': {
-                'state': self.__control_state.value,
+                'state': ControlState(self.__state.control_state),
                 'error': self.__error_msg,
                 'actual_temperatures': {
-                    'times': self.__curve_duration_history,
-                    'temperatures': self.__curve_temperature_history
+                    'times': self.__curve_duration_history[:self.__history_length].tolist(),
+                    'temperatures': self.__curve_temperature_history[:self.__history_length].tolist()
                 }
             }
-        })
+        }
 
     @property
     def temperature(self) -> float:
-        return self.__temperatures[-1][1]
+        return self.__temperature_values[-1]
 
     @temperature.setter
     def temperature(self, temperature: float):
         current_time = time.monotonic()
-        self.__current_temperature.value = temperature
-        self.__temperatures.append((current_time, temperature))
-        # prune old temperatures
-        self.__temperatures = [t for t in self.__temperatures if
-                               t[0] > (current_time - temperature_derivation_timescale.total_seconds())]
-        self.__current_temperature_derivative.value = calculate_derivative(self.__temperatures)
+        self.__state.temperature = temperature
+        self.__temperature_times.append(current_time)
+        self.__temperature_values.append(temperature)
+        # prune old temperatures, they are in time order so only the left end needs to be checked
+        oldest_time = current_time - temperature_derivation_timescale.total_seconds()
+        while self.__temperature_times[0] <= oldest_time:
+            self.__temperature_times.popleft()
+            self.__temperature_values.popleft()
+        # slope across the window, only the oldest and newest samples are needed for that
+        start_time, start_temperature = self.__temperature_times[0], self.__temperature_values[0]
+        if current_time > start_time:
+            self.__state.temperature_derivative = (temperature - start_temperature) / (current_time - start_time)
+        else:
+            self.__state.temperature_derivative = 0
 
     @property
     def door_open(self) -> bool:
-        return self.__current_door_open.value
+        return self.__state.door_open
 
     @door_open.setter
     def door_open(self, door_open: bool):
-        self.__current_door_open.value = door_open
+        self.__state.door_open = door_open
 
     def start(self, curve: ReflowCurveSchema):
         if self.busy:
             raise RuntimeError('Control process is already running')
 
+        # convert the curve to contiguous float arrays once here, everything after this works on the arrays
+        curve = dict(curve,
+                     times=np.ascontiguousarray(curve['times'], dtype=np.float64),
+                     temperatures=np.ascontiguousarray(curve['temperatures'], dtype=np.float64))
         self.__curve = curve
-        self.__control_state.value = ControlState.IDLE.value
+        self.__state.control_state = ControlState.IDLE.value
         self.__should_exit_mpc.clear()
-        self.__curve_duration_history = []
-        self.__curve_temperature_history = []
-        self.__curve_duration.value = 0
-
-        self.__control_process = multiprocessing.Process(target=_run_curve,
-                                                         args=(curve, self.__control_state,
-                                                               self.__current_temperature,
-                                                               self.__current_temperature_derivative,
-                                                               self.__current_door_open,
-                                                               self.__desired_oven_state,
-                                                               self.__desired_duty_cycle,
-                                                               self.__curve_duration,
-                                                               self.__should_exit_mpc))
-        self.__control_process.start()
+        self.__history_length = 0
+        self.__state.curve_duration = 0
+
+        # the control worker is started once and kept, so it can reuse the MPC set up for a curve on later runs
+        if not (self.__control_process and self.__control_process.is_alive()):
+            self.__control_process = multiprocessing.Process(target=_control_worker,
+                                                             args=(self.__curve_reader, self.__state,
+                                                                   self.__should_exit_mpc, self.__should_exit),
+                                                             daemon=True)
+            self.__control_process.start()
+
+        self.__state.running = True
+        self.__curve_writer.send(curve)
 
     def stop(self):
         if self.busy:
-            self.__control_state.value = ControlState.CANCELLED.value
-            self.__desired_oven_state.value = OvenState.IDLE.value
+            self.__state.control_state = ControlState.CANCELLED.value
+            self.__state.desired_oven_state = OvenState.IDLE.value
             self.__should_exit_mpc.set()
@@ -1,14 +1,22 @@
-import json
-import multiprocessing
-import queue
+import datetime
+import functools
+import hashlib
+import logging
 import os
+import re
+import socket
+import threading
+import time
 import uuid
 
-from flask import Flask, request, jsonify
+import orjson
+from flask import Blueprint, Flask, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_socketio import SocketIO, emit
 from apispec import APISpec
 from apispec.ext.marshmallow import MarshmallowPlugin
 from apispec_webframeworks.flask import FlaskPlugin
+from werkzeug.serving import WSGIRequestHandler
 
 from schemas import *
 from tms import ThermalManagementSystem
@@ -18,7 +26,7 @@ from mpc import ModelPredictiveControl
 import warnings
 
 warnings.simplefilter('always')
-from pprint import pprint
+logging.basicConfig(level=logging.INFO)
 
 from constants import ControlState, LogSeverity
 
@@ -100,43 +108,119 @@ spec = APISpec(
     }
 )
 
+
+class NoDelayRequestHandler(WSGIRequestHandler):
+    """
+    Development server request handler that disables Nagle's algorithm, so small Socket.IO frames are sent right away
+    """
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class OrjsonProvider(JSONProvider):
+    """
+    Flask JSON provider that encodes and decodes with orjson
+    """
+
+    def dumps(self, obj, **kwargs) -> str:
+        return OrjsonSocketIO.dumps(obj)
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+class OrjsonSocketIO:
+    """
+    Drop-in for the json module used by python-socketio to encode and decode packets
+    """
+
+    @staticmethod
+    def dumps(obj, *args, **kwargs) -> str:
+        # python-socketio passes stdlib options like separators, orjson output is always compact
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    @staticmethod
+    def loads(s, *args, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
-socketio = SocketIO(app)
+app.json = OrjsonProvider(app)
+# HTTP routes are collected on a blueprint and registered with the app in one go once they are all defined
+api = Blueprint('reflow', __name__)
+# websocket only, so each client holds one persistent connection instead of long-polling with an HTTP request per
+# message. Clients have to connect with transports: ['websocket'].
+socketio = SocketIO(app, json=OrjsonSocketIO, transports=['websocket'], ping_interval=25, ping_timeout=60)
+
+# minimum time between two flushes of queued events, events arriving in between are sent together. This also caps
+# status updates to clients at 10 per second
+emit_write_delay = datetime.timedelta(milliseconds=100)
+# events that carry the complete current status, a newer one makes any older one that wasn't sent yet obsolete
+_status_events = frozenset({'oven_status', 'reflow_status'})
+
+# events waiting for emit_status. Status events only keep the newest payload of each, everything else is sent in order
+_pending_statuses = {}
+_pending_events = []
+_pending_lock = threading.Lock()
+# set when something was queued, so emit_status only wakes up when there is something to send
+_emit_pending = threading.Event()
+
+# schemas are reused between requests instead of being rebuilt for every call
+_curve_schema = ReflowCurveSchema()
+_control_status_schema = ControlStatusSchema()
+_oven_status_schema = OvenStatusSchema()
+_log_messages_schema = LogMessagesSchema()
+# (log version, serialized logs) of the last logs request
+_logs_cache = (-1, b'')
+# response formats of the logs endpoint, the first one is used when the client has no preference
+_logs_mimetypes = ['application/json', 'application/x-ndjson']
+
+
+def queue_event(event: str, data):
+    # events are passed on as they are, the socketio orjson shim encodes the status dataclasses and dicts directly. They
+    # have the same fields as their schemas, and enums are encoded by value like the schemas do
+    with _pending_lock:
+        if event in _status_events:
+            _pending_statuses[event] = data
+        else:
+            _pending_events.append((event, data))
+        _emit_pending.set()
+
+
+def handle_oven_status(status: OvenStatus):
+    mpc.temperature = status.temperature
+    mpc.door_open = status.door_open
+    queue_event('oven_status', status)
+    if status.state == OvenState.FAULT:
+        mpc.stop()
 
-emit_queue = multiprocessing.Queue()
 
+# callbacks are bound with partial instead of wrapping each one in a lambda
 mpc = ModelPredictiveControl(
-    # on_reflow_status=lambda status: socketio.emit('reflow_status', ReflowStatusSchema().dump(status))
-    on_reflow_status=lambda status: emit_queue.put_nowait(('reflow_status', ReflowStatusSchema().dump(status))))
+    on_reflow_status=functools.partial(queue_event, 'reflow_status'))
 tms = ThermalManagementSystem(
-    on_log_message=lambda message: emit_queue.put_nowait(('log_message', LogMessageSchema().dump(message))),
-    on_oven_status=lambda status: emit_queue.put_nowait(('oven_status', OvenStatusSchema().dump(status))),
+    on_log_message=functools.partial(queue_event, 'log_message'),
+    on_oven_status=handle_oven_status,
 )
 
 mpc.on_desired_duty_cycle = tms.set_duty_cycle
 # Directory to store saved curves
 SAVED_CURVES_DIR = "saved_curves"
+# saved curves are named by the string form of a uuid4
+_curve_id_pattern = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}\Z')
+# parsed saved curves by file name, together with the modification time of the file when it was read
+_curve_cache = {}
 
 # Ensure the directory for saved curves exists
-if not os.path.exists(SAVED_CURVES_DIR):
-    os.makedirs(SAVED_CURVES_DIR)
+os.makedirs(SAVED_CURVES_DIR, exist_ok=True)
 
 mpc.on_desired_oven_state = tms.set_oven_state
 
 
-def handle_oven_status(status):
-    mpc.temperature = status['temperature']
-    mpc.door_open = status['door_open']
-    emit_queue.put_nowait(('oven_status', OvenStatusSchema().dump(status)))
-    if status['state'] == OvenState.FAULT:
-        mpc.stop()
-
-
-tms.on_oven_status = handle_oven_status
-
-
 # Use the schema to document the route
-@app.route('/start_curve', methods=['POST'])
+@api.route('/start_curve', methods=['POST'])
 def start_curve():
     """
     Start a thermal curve process.
@@ -156,7 +240,7 @@ def start_curve():
     # Validate the curve data, times and temperatures must ascend
     curve_data = request.get_json()
     try:
-        curve = ReflowCurveSchema().load(curve_data)
+        curve = _curve_schema.load(curve_data)
         mpc.start(curve)
         return jsonify({'status': 'success', 'message': 'Curve process started.'}), 200
     except ValidationError as err:
@@ -165,7 +249,7 @@ def start_curve():
         return jsonify({'status': 'error', 'message': str(err)}), 400
 
 
-@app.route('/curve_status', methods=['GET'])
+@api.route('/curve_status', methods=['GET'])
 def curve_status():
     """
     Get the current status of the thermal curve process.
@@ -179,10 +263,10 @@ def curve_status():
             application/json:
               schema: ControlStatusSchema
     """
-    return ControlStatusSchema().dump(mpc.status), 200
+    return _control_status_schema.dump(mpc.status), 200
 
 
-@app.route('/oven_status', methods=['GET'])
+@api.route('/oven_status', methods=['GET'])
 def oven_status():
     """
     Get the current status of the oven.
@@ -196,10 +280,10 @@ def oven_status():
             application/json:
               schema: OvenStatusSchema
     """
-    return OvenStatusSchema().dump(tms.oven_status), 200
+    return _oven_status_schema.dump(tms.oven_status), 200
 
 
-@app.route('/stop_curve', methods=['POST'])
+@api.route('/stop_curve', methods=['POST'])
 def stop_curve():
     """
     Stop the thermal curve process.
@@ -216,68 +300,91 @@ def stop_curve():
     return jsonify({'status': 'success', 'message': 'Curve process stopped.'}), 200
 
 
+def _write_curve_file(fd: int, curve_data):
+    """
+    Write a curve as JSON to an open file descriptor and close it
+
+    :param fd: The file descriptor to write to
+    :param curve_data: The curve to write
+    """
+    try:
+        data = memoryview(orjson.dumps(curve_data))
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+
+
 # Endpoint to save a curve
-@app.route('/save_curve', methods=['POST'])
+@api.route('/save_curve', methods=['POST'])
 def save_curve():
     curve_data = request.get_json()
     try:
-        curve = ReflowCurveSchema().load(curve_data)
+        curve = _curve_schema.load(curve_data)
         curve["id"] = str(uuid.uuid4())
         curve_path = os.path.join(SAVED_CURVES_DIR, f"{curve['id']}.json")
-        with open(curve_path, 'w') as curve_file:
-            json.dump(curve_data, curve_file)
+        # O_EXCL, so an existing curve is never overwritten
+        _write_curve_file(os.open(curve_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644), curve_data)
         return curve['id'], 200
     except (ValidationError, ValueError) as err:
         return jsonify({'status': 'error', 'message': str(err)}), 400
 
 
 # endpoint to update a curve. JSON curve in post body, with id in request args
-@app.route('/update_curve/<string:curve_id>', methods=['POST'])
+@api.route('/update_curve/<string:curve_id>', methods=['POST'])
 def update_curve(curve_id):
     # make sure curve_id is a valid uuid
-    try:
-        uuid.UUID(curve_id)
-    except ValueError:
+    if not _curve_id_pattern.match(curve_id):
         return jsonify({'status': 'error', 'message': 'Curve not found.'}), 400
 
-    # make sure curve_id exists in saved curves
     curve_path = os.path.join(SAVED_CURVES_DIR, f"{curve_id}.json")
-    if not os.path.exists(curve_path):
-        return jsonify({'status': 'error', 'message': 'Curve not found.'}), 400
     curve_data = request.get_json()
     try:
-        curve = ReflowCurveSchema().load(curve_data)
+        curve = _curve_schema.load(curve_data)
         curve["id"] = curve_id
-        with open(curve_path, 'w') as curve_file:
-            json.dump(curve_data, curve_file)
+        # without O_CREAT opening fails if the curve doesn't exist, there is no separate existence check to race with
+        _write_curve_file(os.open(curve_path, os.O_WRONLY | os.O_TRUNC), curve_data)
+        # the modification time might not change on file systems with coarse timestamps
+        _curve_cache.pop(f"{curve_id}.json", None)
         return jsonify({'status': 'success', 'message': 'Curve saved successfully.'}), 200
+    except FileNotFoundError:
+        return jsonify({'status': 'error', 'message': 'Curve not found.'}), 400
     except (ValidationError, ValueError) as err:
         return jsonify({'status': 'error', 'message': str(err)}), 400
 
 
 # delete curve with uuid
-@app.route('/delete_curve/<string:curve_id>', methods=['DELETE'])
+@api.route('/delete_curve/<string:curve_id>', methods=['DELETE'])
 def delete_curve(curve_id):
-    # make sure curve_id exists in saved curves
     curve_path = os.path.join(SAVED_CURVES_DIR, f"{curve_id}.json")
-    if not os.path.exists(curve_path):
+    try:
+        os.remove(curve_path)
+    except FileNotFoundError:
         return jsonify({'status': 'error', 'message': 'Curve not found.'}), 400
-    os.remove(curve_path)
+    _curve_cache.pop(f"{curve_id}.json", None)
     return jsonify({'status': 'success', 'message': 'Curve deleted successfully.'}), 200
 
 
 # Endpoint to get all saved curves
-@app.route('/curves', methods=['GET'])
+@api.route('/curves', methods=['GET'])
 def get_curves():
     curves = []
-    for filename in os.listdir(SAVED_CURVES_DIR):
-        if filename.endswith('.json'):
-            with open(os.path.join(SAVED_CURVES_DIR, filename), 'r') as curve_file:
-                curves.append(json.load(curve_file))
+    with os.scandir(SAVED_CURVES_DIR) as entries:
+        for entry in entries:
+            if entry.name.endswith('.json') and entry.is_file():
+                # only parse curves that are new or were modified since they were last read
+                modified_time = entry.stat().st_mtime_ns
+                cached = _curve_cache.get(entry.name)
+                if cached is None or cached[0] != modified_time:
+                    # read the raw bytes in one go and parse them with orjson, skipping the text decoding layer
+                    with open(entry.path, 'rb') as curve_file:
+                        cached = (modified_time, orjson.loads(curve_file.read()))
+                    _curve_cache[entry.name] = cached
+                curves.append(cached[1])
     return jsonify(curves), 200
 
 
-@app.route('/reset', methods=['POST'])
+@api.route('/reset', methods=['POST'])
 def reset_device():
     """
     Reset the device.
@@ -294,28 +401,42 @@ def reset_device():
     return jsonify({'status': 'success', 'message': 'Device reset.'}), 200
 
 
-@app.route('/logs', methods=['GET'])
+@api.route('/logs', methods=['GET'])
 def get_logs():
     """
     Get the current logs.
     ---
     get:
-      description: Get the current logs.
+      description: Get the current logs. Clients that accept application/x-ndjson get one log message per line.
       responses:
         200:
           description: Current logs.
           content:
             application/json:
               schema: LogMessagesSchema
+            application/x-ndjson:
+              schema: LogMessageSchema
     """
-    return LogMessagesSchema().dump({'logs': tms.log_messages}), 200
+    if request.accept_mimetypes.best_match(_logs_mimetypes) == 'application/x-ndjson':
+        # snapshot the buffer, the TMS keeps appending to it while the response is streamed
+        logs = list(tms.log_messages)
+        # orjson encodes the LogMessage dataclasses and their severity enum by value, same as LogMessageSchema
+        return app.response_class((orjson.dumps(log) + b'\n' for log in logs), mimetype='application/x-ndjson'), 200
+
+    global _logs_cache
+    version = tms.log_version
+    if _logs_cache[0] != version:
+        # only serialize again when messages were added since the last request
+        _logs_cache = (version, orjson.dumps(_log_messages_schema.dump({'logs': list(tms.log_messages)})))
+    return app.response_class(_logs_cache[1], mimetype='application/json'), 200
 
 
 # To generate OpenAPI documentation
-@app.route("/openapi.json")
+@api.route("/openapi.json")
 def create_openapi_spec():
-    print(json.dumps(spec.to_dict(), indent=2))
-    return jsonify(spec.to_dict())
+    response = app.response_class(_openapi_json, mimetype='application/json')
+    response.set_etag(_openapi_etag)
+    return response.make_conditional(request)
 
 
 @socketio.on('connect')
@@ -324,7 +445,8 @@ def on_connect():
     # # Send the current status of the reflow process
     # emit('reflow_status', ReflowStatusSchema().dump(mpc.status))
     # # Send the current status of the oven
-    emit('oven_status', OvenStatusSchema().dump(tms.oven_status))
+    if tms.oven_status is not None:
+        emit('oven_status', tms.oven_status)
     # # Send the current logs
     # emit('log_message', LogMessagesSchema().dump({'logs': tms.log_messages}))
 
@@ -335,32 +457,57 @@ def on_disconnect():
     print('Client disconnected')
 
 
-# background task to emit the current status of the reflow process from the queue
+# background task to emit the current status of the reflow process from the pending events
 def emit_status():
+    global _pending_statuses, _pending_events
+    last_flush_time = 0.0
     while True:
-        try:
-            to_emit = emit_queue.get_nowait()
-            socketio.emit(to_emit[0], to_emit[1])
-        except queue.Empty:
-            pass
-        socketio.sleep(0.1)
+        # block until there is something to send instead of waking up periodically
+        _emit_pending.wait()
+
+        # keep to the write delay, only sleeping for what is left of it since the last flush
+        remaining_delay = emit_write_delay.total_seconds() - (time.monotonic() - last_flush_time)
+        if remaining_delay > 0:
+            socketio.sleep(remaining_delay)
+
+        # take everything that was queued in the meantime, not just a single event
+        with _pending_lock:
+            events, statuses = _pending_events, _pending_statuses
+            _pending_events, _pending_statuses = [], {}
+            _emit_pending.clear()
 
+        for event, data in events:
+            socketio.emit(event, data)
+        for event, data in statuses.items():
+            socketio.emit(event, data)
+        last_flush_time = time.monotonic()
+
+
+app.register_blueprint(api)
 
 with app.test_request_context():
     # Register the schema with the spec
-    spec.path(view=start_curve, app=app)
-    spec.path(view=curve_status, app=app)
-    spec.path(view=stop_curve, app=app)
-    spec.path(view=reset_device, app=app)
-    spec.path(view=get_logs, app=app)
-    spec.path(view=oven_status, app=app)
+    for view in (start_curve, curve_status, stop_curve, reset_device, get_logs, oven_status):
+        spec.path(view=view, app=app)
+
+# the spec doesn't change at runtime, so it's encoded once and clients can revalidate it with its ETag
+_openapi_json = orjson.dumps(spec.to_dict())
+_openapi_etag = hashlib.blake2b(_openapi_json, digest_size=8).hexdigest()
+
+
+def shutdown():
+    """
+    Stop the oven and control processes and their threads, so the server process can exit
+    """
+    print('Exiting...')
+    tms.close()
+    mpc.close()
+
 
 if __name__ == "__main__":
     socketio.start_background_task(emit_status)
     try:
-        socketio.run(app, host='0.0.0.0', port=5000)
+        socketio.run(app, host='0.0.0.0', port=5000, request_handler=NoDelayRequestHandler)
     except KeyboardInterrupt:
-        print('Exiting...')
-        del tms
-        del mpc
+        shutdown()
         socketio.stop()
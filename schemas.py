@@ -1,3 +1,7 @@
+from dataclasses import dataclass, field
+from typing import List
+
+import numpy as np
 from marshmallow import Schema, fields, validates, ValidationError, validates_schema
 from constants import ControlState, LogSeverity, OvenState
 
@@ -13,9 +17,9 @@ class ReflowCurveSchema(Schema):
 
     @validates('times')
     def validate_times(self, value):
-        # they must be in ascending order
-        if value != sorted(value):
-            raise ValidationError('Times must be in ascending order')
+        # they must be in strictly ascending order, a repeated time makes the curve ambiguous
+        if np.any(np.diff(value) <= 0):
+            raise ValidationError('Times must be in strictly ascending order')
 
     @validates_schema
     def validate_lengths(self, data, **kwargs):
@@ -38,6 +42,19 @@ class ControlStatusSchema(Schema):
     reflow = fields.Nested(ReflowStatusSchema, required=True, metadata={'description': "The control data"})
 
 
+@dataclass
+class OvenStatus:
+    """
+    Status of the oven as passed around internally, only converted with OvenStatusSchema at the API boundary
+    """
+    time: int
+    temperature: float
+    state: OvenState
+    duty_cycle: int
+    door_open: bool
+    errors: List[str] = field(default_factory=list)
+
+
 class OvenStatusSchema(Schema):
     time = fields.Int(required=True, metadata={'description': "Time in milliseconds since startup"})
     temperature = fields.Float(required=True, metadata={'description': "The current temperature of the oven"})
@@ -52,6 +69,16 @@ class OvenStatusSchema(Schema):
             raise ValidationError('Duty cycle must be between 0 and 100')
 
 
+@dataclass
+class LogMessage:
+    """
+    Log message of the oven as passed around internally, only converted with LogMessageSchema at the API boundary
+    """
+    message: str
+    severity: LogSeverity
+    time: int
+
+
 class LogMessageSchema(Schema):
     message = fields.String(required=True, metadata={'description': "The log message"})
     severity = fields.Enum(LogSeverity, by_value=True, required=True, metadata={'description': "Severity of the log message"})
@@ -1,15 +1,18 @@
+import collections
 import datetime
-import json
 import multiprocessing
-import queue
+import pickle
+import select
 import threading
 import time
 import gpiod
+import orjson
 from pprint import pprint
 
 import serial
 from ctypes import c_int
-from typing import Callable, List
+from multiprocessing.connection import Connection
+from typing import Callable, Deque, List
 
 from schemas import *
 from utils import error_to_strings
@@ -17,70 +20,140 @@ from utils import error_to_strings
 heartbeat_send_interval = datetime.timedelta(milliseconds=500)
 # expect to receive a heartbeat at least every second
 heartbeat_receive_threshold = datetime.timedelta(milliseconds=1000)
+# longest a serial read blocks, bounds how late a heartbeat can be sent
+serial_read_timeout = datetime.timedelta(milliseconds=100)
 
 print_status_interval = datetime.timedelta(seconds=2)
 
 reset_line = 15
-
-
-def _handle_communication(status_queue: multiprocessing.Queue, log_queue: multiprocessing.Queue,
-                          duty_cycle: multiprocessing.Value, oven_state: multiprocessing.Value, serial_port: str,
-                          baud_rate: int, should_exit: multiprocessing.Event, should_reset: multiprocessing.Event):
+reset_pulse_duration = datetime.timedelta(milliseconds=100)
+
+# number of log messages kept for the logs endpoint, older ones are dropped
+log_history_size = 500
+# longer log messages are truncated, so every message fits in a single atomic pipe write
+log_message_max_length = 512
+# how often the number of messages dropped because the monitor thread fell behind is reported
+dropped_messages_report_interval = datetime.timedelta(seconds=10)
+
+
+def _parse_oven_status(data: dict) -> OvenStatus:
+    """
+    Build the oven status from a status message of the controller. This runs for every received line, so the fields are
+    converted directly instead of through OvenStatusSchema
+
+    :param data: The decoded status message
+    :return: The oven status
+    """
+    duty_cycle = int(data['pwm'])
+    if duty_cycle < 0 or duty_cycle > 100:
+        raise ValueError('Duty cycle must be between 0 and 100')
+    return OvenStatus(time=int(data['time']),
+                      temperature=float(data['current']),
+                      state=OvenState(data['state']),
+                      duty_cycle=duty_cycle,
+                      door_open=data['door'] == 'open',
+                      errors=error_to_strings(data['error']))
+
+
+def _parse_log_message(data: dict) -> LogMessage:
+    """
+    Build a log message from a log message of the controller, converted directly like the oven status
+
+    :param data: The decoded log message
+    :return: The log message
+    """
+    return LogMessage(message=str(data['message'])[:log_message_max_length], severity=LogSeverity(data['severity']),
+                      time=int(data['time']))
+
+
+def _send_message(message_pipe: Connection, message) -> bool:
+    """
+    Send a message to the monitor thread without ever blocking the serial loop
+
+    :param message_pipe: The writing end of the message pipe
+    :param message: The oven status or log message to send
+    :return: Whether the message was sent, it is dropped if the pipe is full
+    """
+    payload = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    # a pipe only counts as writable with room for at least PIPE_BUF bytes, and send_bytes writes a payload this small
+    # together with its 4 byte length header in one write, so it can't block
+    if len(payload) > select.PIPE_BUF - 4:
+        return False
+    _, writable, _ = select.select((), (message_pipe,), (), 0)
+    if not writable:
+        return False
+    message_pipe.send_bytes(payload)
+    return True
+
+
+def _handle_communication(message_pipe: Connection, duty_cycle: multiprocessing.RawValue,
+                          oven_state: multiprocessing.RawValue, serial_port: str, baud_rate: int,
+                          should_exit: multiprocessing.Event, should_reset: multiprocessing.Event):
     while not should_exit.is_set():
         try:
-            with serial.Serial(serial_port, baud_rate, timeout=1) as ser:
+            # reads block until a full line arrives or the read timeout passes, so there is no need to poll. The timeout
+            # is fixed, changing it reconfigures the port
+            with serial.Serial(serial_port, baud_rate, timeout=serial_read_timeout.total_seconds()) as ser:
                 last_send_time = time.monotonic()
                 last_receive_time = time.monotonic()
+                # start of a line that was cut off by a read timeout, reused for the whole connection
+                partial_line = bytearray()
+                # the heartbeat is only encoded again when the values in it change
+                heartbeat_values = None
+                heartbeat = b''
+                dropped_messages = 0
+                last_dropped_report_time = time.monotonic()
 
                 while not should_exit.is_set():
-                    # check if serial data is available
-                    if ser.in_waiting > 0:
-                        # read a line
-                        line = ser.readline().decode().strip()
-                        if line:
+                    chunk = ser.readline()
+                    if chunk.endswith(b'\n'):
+                        # a complete line is parsed as read, only a cut off one is joined in the buffer first. orjson
+                        # parses the raw bytes and skips the surrounding whitespace, so no decode or strip is needed
+                        if partial_line:
+                            partial_line += chunk
+                            line = partial_line
+                        else:
+                            line = chunk
+                        if not line.isspace():
                             try:
-                                data = json.loads(line)
+                                data = orjson.loads(line)
                                 if 'current' in data:
                                     # status object
-                                    parsed_data = OvenStatusSchema().load({
-                                        "time": data['time'],
-                                        "temperature": data['current'],
-                                        "state": data['state'],
-                                        "duty_cycle": data['pwm'],
-                                        "door_open": data['door'] == 'open',
-                                        "errors": error_to_strings(data['error'])
-                                    })
-                                    status_queue.put_nowait(parsed_data)
+                                    message = _parse_oven_status(data)
                                 else:
                                     # log message
-                                    parsed_data = LogMessageSchema().load({
-                                        "message": data['message'],
-                                        "severity": data['severity'],
-                                        "time": data['time']
-                                    })
-                                    log_queue.put_nowait(parsed_data)
+                                    message = _parse_log_message(data)
+                                if not _send_message(message_pipe, message):
+                                    dropped_messages += 1
                                 last_receive_time = time.monotonic()
-                            except json.JSONDecodeError:
-                                # log warning
-                                pass
-                            except queue.Empty:
+                            except orjson.JSONDecodeError:
                                 # log warning
                                 pass
                             except Exception as e:
                                 # log error
                                 pass
-                        else:
-                            # log warning, trigger reset
-                            pass
+                        partial_line.clear()
+                    elif chunk:
+                        # the read timed out in the middle of a line, keep the start of it for the next read
+                        partial_line += chunk
                     elif (time.monotonic() - last_receive_time) >= heartbeat_receive_threshold.total_seconds():
                         # log warning
                         should_reset.set()
 
                     if (time.monotonic() - last_send_time) >= heartbeat_send_interval.total_seconds():
-                        ser.write(json.dumps({'state': oven_state.value, 'pwm': duty_cycle.value}).encode())
+                        values = (oven_state.value, duty_cycle.value)
+                        if values != heartbeat_values:
+                            heartbeat_values = values
+                            heartbeat = orjson.dumps({'state': values[0], 'pwm': values[1]})
+                        ser.write(heartbeat)
                         last_send_time = time.monotonic()
 
-                    time.sleep(0.1)
+                    # report dropped messages as a periodic count, one line per message would flood the log
+                    if dropped_messages and (time.monotonic() - last_dropped_report_time >=
+                                             dropped_messages_report_interval.total_seconds()):
+                        print(f"tms message pipe full, dropped {dropped_messages} messages")
+                        dropped_messages = 0
+                        last_dropped_report_time = time.monotonic()
         except KeyboardInterrupt:
             print("tms keyboardinterrupt")
             should_exit.set()
@@ -94,96 +167,127 @@ def _handle_communication(status_queue: multiprocessing.Queue, log_queue: multip
 
 
 class ThermalManagementSystem:
-    __log_messages: List[LogMessageSchema] = []
-    __oven_status: OvenStatusSchema = None
+    __log_messages: Deque[LogMessage]
+    __log_version = 0
+    __oven_status: OvenStatus = None
 
-    __duty_cycle = multiprocessing.Value(c_int)
-    __oven_state = multiprocessing.Value(c_int)
+    # each value has a single writer and aligned int reads and writes are atomic, so they don't need a lock
+    __duty_cycle = multiprocessing.RawValue(c_int)
+    __oven_state = multiprocessing.RawValue(c_int)
     __should_exit = multiprocessing.Event()
     __should_reset = multiprocessing.Event()
 
-    __status_queue = multiprocessing.Queue()
-    __log_queue = multiprocessing.Queue()
+    # oven status and log messages from the communication process, in the order they were received. There is exactly
+    # one writer and one reader, so a plain pipe is enough and avoids the locks and feeder thread of a queue
+    __message_reader, __message_writer = multiprocessing.Pipe(duplex=False)
 
     __communication_process: multiprocessing.Process = None
     __monitor_thread: threading.Thread
+    __reset_thread: threading.Thread
 
-    on_log_message: Callable[[LogMessageSchema], None] = None
-    on_oven_status: Callable[[OvenStatusSchema], None] = None
+    on_log_message: Callable[[LogMessage], None] = None
+    on_oven_status: Callable[[OvenStatus], None] = None
     on_reset: Callable[[], None] = None
 
     def __init__(self, serial_port='/dev/ttyUSB0', baud_rate=115200,
-                 on_log_message: Callable[[LogMessageSchema], None] = None,
-                 on_oven_status: Callable[[OvenStatusSchema], None] = None,
+                 on_log_message: Callable[[LogMessage], None] = None,
+                 on_oven_status: Callable[[OvenStatus], None] = None,
                  on_reset: Callable[[], None] = None):
 
         self.on_log_message = on_log_message
         self.on_oven_status = on_oven_status
         self.on_reset = on_reset
 
+        self.__log_messages = collections.deque(maxlen=log_history_size)
+
         self.__communication_process = multiprocessing.Process(target=_handle_communication, args=(
-            self.__status_queue, self.__log_queue, self.__duty_cycle, self.__oven_state, serial_port, baud_rate,
-            self.__should_exit, self.__should_reset))
+            self.__message_writer, self.__duty_cycle, self.__oven_state, serial_port, baud_rate, self.__should_exit,
+            self.__should_reset))
 
         self.__monitor_thread = threading.Thread(target=self.__monitor)
         self.__monitor_thread.start()
+        self.__reset_thread = threading.Thread(target=self.__reset)
+        self.__reset_thread.start()
         self.__communication_process.start()
 
     def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Stop the communication process and the monitor and reset threads
+        """
         print('tms set should exit')
         self.__should_exit.set()
         print('tms comm process join')
         self.__communication_process.join()
         print('tms monitor join')
         self.__monitor_thread.join()
+        print('tms reset join')
+        self.__reset_thread.join()
         print('tms del done')
 
     def __monitor(self):
         """
-        Monitor the status and log queues and call the appropriate callbacks
+        Monitor the message pipe and call the appropriate callbacks
         """
-        with gpiod.request_lines('/dev/gpiochip2', consumer="reflow-backend", config={
-            reset_line: gpiod.LineSettings(direction=gpiod.line.Direction.OUTPUT, output_value=gpiod.line.Value.ACTIVE)
-        }) as gpio_request:
-
-            last_print_status_time = time.monotonic()
-            while (not self.__should_exit.is_set()) or not self.__status_queue.empty() or not self.__log_queue.empty():
-                try:
-                    status = self.__status_queue.get_nowait()
+        last_print_status_time = time.monotonic()
+        while (not self.__should_exit.is_set()) or self.__message_reader.poll():
+            # wait for the next message instead of polling, the timeout keeps exiting responsive
+            message = self.__message_reader.recv() if self.__message_reader.poll(0.1) else None
+
+            # a failing callback must not end this thread, the communication process would be left with nobody
+            # reading its messages
+            try:
+                if isinstance(message, OvenStatus):
                     if (time.monotonic() - last_print_status_time) >= print_status_interval.total_seconds():
                         last_print_status_time = time.monotonic()
-                        pprint(status)
+                        pprint(message)
+                    self.__oven_status = message
                     if self.on_oven_status:
-                        self.on_oven_status(status)
-                    self.__oven_status = status
-                except queue.Empty:
-                    pass
-
-                try:
-                    log = self.__log_queue.get_nowait()
-                    self.__log_messages.append(log)
-                    pprint(log)
+                        self.on_oven_status(message)
+                elif message is not None:
+                    self.__log_messages.append(message)
+                    self.__log_version += 1
+                    pprint(message)
                     if self.on_log_message:
-                        self.on_log_message(log)
-                except queue.Empty:
-                    pass
-
-                if self.__should_reset.is_set():
-                    gpio_request.set_value(reset_line, gpiod.line.Value.INACTIVE)
-                    time.sleep(0.1)
-                    gpio_request.set_value(reset_line, gpiod.line.Value.ACTIVE)
-                    self.__should_reset.clear()
-                    if self.on_reset:
-                        self.on_reset()
+                        self.on_log_message(message)
+            except Exception as e:
+                print("tms callback exception")
+                print(e)
 
-                time.sleep(0.1)
+    def __reset(self):
+        """
+        Pulse the reset line of the oven controller whenever a reset is requested. This runs on its own thread, so
+        the pulse doesn't hold up status and log messages
+        """
+        with gpiod.request_lines('/dev/gpiochip2', consumer="reflow-backend", config={
+            reset_line: gpiod.LineSettings(direction=gpiod.line.Direction.OUTPUT, output_value=gpiod.line.Value.ACTIVE)
+        }) as gpio_request:
+            while not self.__should_exit.is_set():
+                # the timeout keeps exiting responsive
+                if not self.__should_reset.wait(0.1):
+                    continue
+                gpio_request.set_value(reset_line, gpiod.line.Value.INACTIVE)
+                time.sleep(reset_pulse_duration.total_seconds())
+                gpio_request.set_value(reset_line, gpiod.line.Value.ACTIVE)
+                self.__should_reset.clear()
+                if self.on_reset:
+                    self.on_reset()
 
     @property
-    def log_messages(self):
+    def log_messages(self) -> Deque[LogMessage]:
         return self.__log_messages
 
     @property
-    def oven_status(self) -> OvenStatusSchema:
+    def log_version(self) -> int:
+        """
+        Incremented for every new log message, so readers can tell whether the logs changed
+        """
+        return self.__log_version
+
+    @property
+    def oven_status(self) -> OvenStatus:
         return self.__oven_status
 
     @property
@@ -1,42 +1,24 @@
-from typing import List, Tuple
-import time
+from typing import List
 
 
-def error_to_strings(error: int) -> List[str]:
-    if error == 0:
-        return []
-    else:
-        errors = []
-        if error & 0x01:
-            errors.append('Door opened during heating')
-        if error & 0x08:
-            errors.append('Current temperature too low')
-        if error & 0x10:
-            errors.append('Current temperature too high')
-        if error & 0x20:
-            errors.append('Current temperature not rising during heating')
-        if error & 0x40:
-            errors.append('Fault while reading current temperature')
-        if error & 0x80:
-            errors.append('UI timeout')
-        return errors
-
-
-def calculate_derivative(data: List[Tuple[float, float]]) -> float:
-    """
-    Calculate the derivative of a list of data points tagged with times
+# messages for the error bits reported by the oven controller
+_error_messages = {
+    0x01: 'Door opened during heating',
+    0x08: 'Current temperature too low',
+    0x10: 'Current temperature too high',
+    0x20: 'Current temperature not rising during heating',
+    0x40: 'Fault while reading current temperature',
+    0x80: 'UI timeout',
+}
+_known_error_bits = sum(_error_messages)
 
-    :param data: The list of data points
-    :return: The derivative of the data points
-    """
-    if len(data) < 2:
-        return 0
 
-    # Calculate the differences and average them.
-    diffs = []
-    for i in range(1, len(data)):
-        time_diff = data[i][0] - data[i - 1][0]
-        temp_diff = data[i][1] - data[i - 1][1]
-        diffs.append(temp_diff / time_diff)
-
-    return sum(diffs) / len(diffs)
\ No newline at end of file
+def error_to_strings(error: int) -> List[str]:
+    # only visit the bits that are set, lowest first. Unknown bits are ignored
+    error &= _known_error_bits
+    errors = []
+    while error:
+        bit = error & -error
+        errors.append(_error_messages[bit])
+        error ^= bit
+    return errors
@@ -0,0 +1,7 @@
+from mpc_server import app, emit_status, socketio
+
+# WSGI entry point for serving the backend with gunicorn, configured in gunicorn.conf.py:
+#   gunicorn -c gunicorn.conf.py wsgi:application
+socketio.start_background_task(emit_status)
+
+application = app